@@ -0,0 +1,224 @@
+"""
+This file is part of typhoon, a request-counting web server.
+Copyright (C) 2014 Ryan Brown <sb@ryansb.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tornado.options import options
+import tornado.options
+
+from typhoon import client
+
+
+Target = collections.namedtuple('Target', 'url weight')
+
+
+class ClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(client._repeated, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Setting a repeatable option runs its callback, so these are put
+        # back by hand, before _repeated itself is restored
+        saved = dict((name, options[name]) for name in ('target', 'weight', 'name'))
+        self.addCleanup(lambda: [setattr(options, name, value)
+                                 for name, value in saved.items()])
+        self.set_options(target_file=None, distribution='round-robin')
+
+    def set_options(self, **values):
+        for name, value in values.items():
+            patcher = mock.patch.object(options.mockable(), name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def parse(self, *args):
+        options.parse_command_line(['typhoon-client'] + list(args), final=False)
+
+    def target_file(self, content):
+        f = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        f.write(content)
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        return f.name
+
+
+class LoadTargetsTest(ClientTestCase):
+
+    def test_repeated_target(self):
+        self.parse('--target=http://a/', '--target=http://b/,http://c/')
+        self.assertEqual(client.load_targets(), [
+            ('http://a/', 1), ('http://b/', 1), ('http://c/', 1)])
+
+    def test_weights(self):
+        self.parse('--target=http://a/,http://b/', '--weight=3', '--weight=1')
+        self.assertEqual(client.load_targets(), [('http://a/', 3), ('http://b/', 1)])
+
+    def test_weight_count_mismatch(self):
+        self.parse('--target=http://a/,http://b/', '--weight=3')
+        self.assertRaises(tornado.options.Error, client.load_targets)
+
+    def test_weights_below_one(self):
+        self.parse('--target=http://a/,http://b/', '--weight=0,0')
+        self.assertRaises(tornado.options.Error, client.load_targets)
+        client._repeated.clear()
+        self.parse('--target=http://a/,http://b/', '--weight=2,-1')
+        self.assertRaises(tornado.options.Error, client.load_targets)
+
+    def test_target_file(self):
+        self.set_options(distribution='weighted', target_file=self.target_file(
+            "# fleet\nhttp://a/ 2\n\nhttp://b/  # default weight\n"))
+        self.assertEqual(client.load_targets(), [('http://a/', 2), ('http://b/', 1)])
+
+    def test_target_file_weights_need_weighted(self):
+        self.set_options(target_file=self.target_file("http://a/ 2\nhttp://b/\n"))
+        self.assertRaises(tornado.options.Error, client.load_targets)
+        self.set_options(target_file=self.target_file("http://a/ 1\nhttp://b/\n"))
+        self.assertEqual(client.load_targets(), [('http://a/', 1), ('http://b/', 1)])
+
+    def test_target_file_bad_weight(self):
+        self.set_options(target_file=self.target_file("http://a/ heavy\n"))
+        self.assertRaises(tornado.options.Error, client.load_targets)
+
+    def test_target_file_with_weight(self):
+        self.set_options(target_file=self.target_file("http://a/\n"))
+        self.parse('--weight=2')
+        self.assertRaises(tornado.options.Error, client.load_targets)
+
+
+class ScheduleTest(ClientTestCase):
+
+    def setUp(self):
+        super(ScheduleTest, self).setUp()
+        self.targets = [Target('a', 3), Target('b', 1), Target('c', 1)]
+        patcher = mock.patch.object(client, 'targets', self.targets)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def urls(self, plan):
+        return ''.join(target.url for target, name in plan)
+
+    def test_check_options(self):
+        self.set_options(distribution='random')
+        self.assertRaises(tornado.options.Error, client.check_options)
+        self.set_options(distribution='hash')
+        self.assertRaises(tornado.options.Error, client.check_options)
+        self.parse('--name=x')
+        client.check_options()
+
+    def test_weight_needs_weighted(self):
+        self.parse('--target=http://a/,http://b/', '--weight=3,1')
+        self.assertRaises(tornado.options.Error, client.check_options)
+        self.set_options(distribution='hash')
+        self.parse('--name=x')
+        self.assertRaises(tornado.options.Error, client.check_options)
+        self.set_options(distribution='weighted')
+        client.check_options()
+
+    def test_round_robin_offset(self):
+        self.assertEqual(self.urls(client.schedule(4)), 'abca')
+        self.assertEqual(self.urls(client.schedule(4, 1)), 'bcab')
+
+    def test_weighted(self):
+        self.set_options(distribution='weighted')
+        plan = self.urls(client.schedule(10))
+        self.assertEqual(plan, 'abacaabaca')
+        self.assertEqual(self.urls(client.schedule(4, 1)), 'baca')
+
+    def test_hash_is_stable(self):
+        self.set_options(distribution='hash')
+        self.parse('--name=x,y,z')
+        first = client.schedule(6)
+        self.assertEqual([name for target, name in first], list('xyzxyz'))
+        self.assertEqual(first[:3], first[3:])
+        self.assertEqual(first, client.schedule(6, 2))
+
+
+class MainTest(ClientTestCase):
+
+    def setUp(self):
+        super(MainTest, self).setUp()
+        stats_dir = tempfile.mkdtemp(prefix="typhoon-test-")
+        self.addCleanup(shutil.rmtree, stats_dir, ignore_errors=True)
+        patcher = mock.patch('tempfile.mkdtemp', return_value=stats_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stats_dir = stats_dir
+
+    def test_interrupted_parent_removes_stats(self):
+        with mock.patch('tornado.process.fork_processes',
+                        side_effect=KeyboardInterrupt), \
+                mock.patch('tornado.options.parse_command_line'):
+            self.assertRaises(KeyboardInterrupt, client.main)
+        self.assertFalse(os.path.exists(self.stats_dir))
+
+    def test_parent_reports_every_target(self):
+        self.parse('--target=http://a/,http://b/')
+        with open(os.path.join(self.stats_dir, '0.json'), 'w') as f:
+            json.dump([
+                {'url': 'http://a/', 'latencies': [0.01], 'error_latencies': [],
+                 'started': 1.0, 'finished': 2.0},
+                {'url': 'http://b/', 'latencies': [], 'error_latencies': [],
+                 'started': None, 'finished': None},
+            ], f)
+        with mock.patch('tornado.process.fork_processes',
+                        side_effect=SystemExit(0)), \
+                mock.patch('tornado.options.parse_command_line'), \
+                mock.patch('builtins.print') as print_:
+            self.assertRaises(SystemExit, client.main)
+        self.assertEqual([c[0][0] for c in print_.call_args_list], [
+            "http://a/: 1 requests, 1.0 req/s, "
+            "latency mean 10.0ms p50 10.0ms p99 10.0ms",
+            "http://b/: no requests completed",
+        ])
+        self.assertFalse(os.path.exists(self.stats_dir))
+
+    def test_missing_worker_stats(self):
+        with mock.patch.object(client, 'stats_dir', self.stats_dir), \
+                mock.patch('builtins.print') as print_:
+            client.print_report(['http://a/'])
+        print_.assert_called_once_with("http://a/: no worker reported stats")
+
+
+class ReportTest(unittest.TestCase):
+
+    def test_merges_workers_and_separates_errors(self):
+        line = client.report([
+            {'url': 'http://a/', 'latencies': [0.010, 0.030],
+             'error_latencies': [0.001], 'started': 10.0, 'finished': 11.0},
+            {'url': 'http://a/', 'latencies': [0.020],
+             'error_latencies': [], 'started': 10.5, 'finished': 12.0},
+        ])
+        self.assertEqual(line, "http://a/: 4 requests, 2.0 req/s, "
+                         "latency mean 20.0ms p50 20.0ms p99 30.0ms, "
+                         "1 errors (mean 1.0ms)")
+
+    def test_nothing_completed(self):
+        line = client.report([{'url': 'http://a/', 'latencies': [],
+                               'error_latencies': [], 'started': None,
+                               'finished': None}])
+        self.assertEqual(line, "http://a/: no requests completed")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,307 @@
+"""
+This file is part of typhoon, a request-counting web server.
+Copyright (C) 2014 Ryan Brown <sb@ryansb.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+from unittest import mock
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.options import options
+import tornado.options
+from tornado.testing import AsyncTestCase, gen_test
+
+from typhoon.server import App, check_flush_options
+
+
+@gen.coroutine
+def settle():
+    """Give chained coroutines a few IOLoop iterations to resume"""
+    for _ in range(5):
+        yield gen.moment
+
+
+def done(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class FlushTestCase(AsyncTestCase):
+    """Runs on a real IOLoop so drains can resume, with the clock and the
+    flush timers replaced by mocks"""
+
+    def setUp(self):
+        super(FlushTestCase, self).setUp()
+        App._counters.clear()
+        self.app = App()
+        self.app.client = mock.Mock()
+        self.app.client.update.side_effect = lambda *a, **kw: done()
+
+        for name in ('time', 'call_at', 'call_later', 'remove_timeout'):
+            patcher = mock.patch.object(self.io_loop, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.io_loop.time.return_value = 100.0
+
+        mockable = options.mockable()
+        for name, value in (('flush_max_keys', 3), ('flush_max_delta', 5),
+                            ('flush_max_age', 1000), ('flush_jitter', 0.2),
+                            ('flush_slice', 2)):
+            patcher = mock.patch.object(mockable, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        App._counters.clear()
+        super(FlushTestCase, self).tearDown()
+
+    def slow_writes(self):
+        """Make every update return a Future the test resolves by hand"""
+        pending = []
+
+        def update(*args, **kwargs):
+            pending.append(Future())
+            return pending[-1]
+        self.app.client.update.side_effect = update
+        return pending
+
+    def failed(self):
+        future = Future()
+        future.set_exception(IOError("mongo went away"))
+        return future
+
+    def written(self):
+        return dict((c[0][0], c[0][1]['$inc']['c'])
+                    for c in self.app.client.update.call_args_list)
+
+
+class TriggerTest(FlushTestCase):
+
+    def test_first_hit_arms_age_timer(self):
+        with mock.patch('random.uniform', return_value=0):
+            self.app.incr('a')
+        self.io_loop.call_at.assert_called_once_with(101.0, self.app.write_counter)
+        self.io_loop.call_later.assert_not_called()
+
+    def test_age_timer_armed_once(self):
+        self.app.incr('a')
+        self.io_loop.time.return_value = 100.5
+        self.app.incr('a')
+        self.assertEqual(self.io_loop.call_at.call_count, 1)
+
+    def test_jitter_bounds(self):
+        with mock.patch('random.uniform', return_value=0.2) as uniform:
+            self.app.incr('a')
+        uniform.assert_called_once_with(0, 0.2)
+        deadline = self.io_loop.call_at.call_args[0][0]
+        self.assertAlmostEqual(deadline, 100.8)
+
+    def test_key_threshold(self):
+        self.app.incr('a')
+        self.app.incr('b')
+        self.io_loop.call_later.assert_not_called()
+        self.app.incr('c')
+        self.io_loop.remove_timeout.assert_called_once_with(self.io_loop.call_at.return_value)
+        self.io_loop.call_later.assert_called_once_with(0, self.app.write_counter)
+
+    def test_delta_threshold(self):
+        for _ in range(4):
+            self.app.incr('a')
+        self.io_loop.call_later.assert_not_called()
+        self.app.incr('a')
+        self.io_loop.call_later.assert_called_once_with(0, self.app.write_counter)
+
+    def test_immediate_flush_armed_once(self):
+        for _ in range(10):
+            self.app.incr('a')
+        self.assertEqual(self.io_loop.call_later.call_count, 1)
+
+
+class DrainTest(FlushTestCase):
+
+    @gen_test
+    def test_drains_everything(self):
+        for name in 'abcde':
+            self.app.incr(name)
+        self.app.incr('a')
+        yield self.app.write_counter()
+        self.assertEqual(self.written(), {'a': 2, 'b': 1, 'c': 1, 'd': 1, 'e': 1})
+        self.assertEqual(len(self.app._counters), 0)
+        self.assertEqual(self.app._pending_delta, 0)
+        self.assertIsNone(self.app._first_pending)
+        self.assertFalse(self.app._flushing)
+
+    @gen_test
+    def test_exact_multiple_of_slice(self):
+        for name in 'abcd':
+            self.app.incr(name)
+        yield self.app.write_counter()
+        self.assertEqual(self.app.client.update.call_count, 4)
+        self.assertFalse(self.app._flushing)
+
+    @gen_test
+    def test_next_slice_waits_for_writes(self):
+        pending = self.slow_writes()
+        for name in 'abcde':
+            self.app.incr(name)
+        drain = self.app.write_counter()
+
+        # Only one slice is in flight until its writes finish
+        yield settle()
+        self.assertEqual(len(pending), 2)
+        pending[0].set_result(None)
+        yield settle()
+        self.assertEqual(len(pending), 2)
+
+        pending[1].set_result(None)
+        yield settle()
+        self.assertEqual(len(pending), 4)
+        self.assertTrue(self.app._flushing)
+
+        for future in pending[2:]:
+            future.set_result(None)
+        yield settle()
+        self.assertEqual(len(pending), 5)
+        pending[4].set_result(None)
+
+        yield drain
+        self.assertFalse(self.app._flushing)
+        self.assertEqual(len(self.app._counters), 0)
+
+    @gen_test
+    def test_failed_write_is_requeued(self):
+        def update(name, *args, **kwargs):
+            if name == 'b':
+                return self.failed()
+            return done()
+        self.app.client.update.side_effect = update
+
+        self.app.incr('a')
+        self.app.incr('b')
+        self.app.incr('b')
+        self.io_loop.call_at.reset_mock()
+        self.io_loop.time.return_value = 100.5
+        with mock.patch.object(self.app.logger, 'error') as error:
+            yield self.app.write_counter()
+        error.assert_called_once()
+        self.assertEqual(dict(self.app._counters), {'b': 2})
+        self.assertEqual(self.app._pending_delta, 2)
+        self.assertEqual(self.app._first_pending, 100.0)
+        self.assertFalse(self.app._flushing)
+        # Retried a full flush_max_age after the failure, not straight away
+        self.io_loop.call_at.assert_called_once_with(101.5, self.app.write_counter)
+
+    @gen_test
+    def test_failed_write_backs_off_size_triggers(self):
+        self.app.client.update.side_effect = lambda *a, **kw: self.failed()
+        self.app.incr('a')
+        with mock.patch.object(self.app.logger, 'error'):
+            yield self.app.write_counter()
+        self.io_loop.call_at.reset_mock()
+
+        for name in 'bcdef':
+            self.app.incr(name)
+        self.io_loop.call_later.assert_not_called()
+        self.io_loop.call_at.assert_not_called()
+
+        # Once the retry time has passed the thresholds apply again
+        self.app._flush_timeout = None
+        self.io_loop.time.return_value = 101.0
+        self.app.incr('g')
+        self.io_loop.call_later.assert_called_once_with(0, self.app.write_counter)
+        self.assertIsNone(self.app._retry_at)
+
+    @gen_test
+    def test_mid_drain_hit_on_later_slice(self):
+        pending = self.slow_writes()
+        self.app.incr('a')
+        self.app.incr('b')
+        self.app.incr('c')
+        drain = self.app.write_counter()
+
+        # 'c' is in the second slice, so this hit is flushed by the same drain
+        self.io_loop.time.return_value = 101.0
+        self.app.incr('c')
+        pending[0].set_result(None)
+        pending[1].set_result(None)
+        yield settle()
+        pending[2].set_result(None)
+        yield drain
+        self.assertEqual(self.written(), {'a': 1, 'b': 1, 'c': 2})
+        self.assertEqual(len(self.app._counters), 0)
+        self.assertIsNone(self.app._first_pending)
+
+        self.io_loop.call_at.reset_mock()
+        self.io_loop.time.return_value = 500.0
+        with mock.patch('random.uniform', return_value=0):
+            self.app.incr('d')
+        self.io_loop.call_at.assert_called_once_with(501.0, self.app.write_counter)
+
+    @gen_test
+    def test_rearms_from_first_hit_after_drain(self):
+        pending = self.slow_writes()
+        self.app.incr('a')
+        self.io_loop.call_at.reset_mock()
+        drain = self.app.write_counter()
+
+        # A hit lands mid-drain, its age clock starts now, not when the drain ends
+        self.io_loop.time.return_value = 102.0
+        self.app.incr('b')
+        self.io_loop.call_at.assert_not_called()
+
+        self.io_loop.time.return_value = 103.0
+        with mock.patch('random.uniform', return_value=0):
+            pending[0].set_result(None)
+            yield drain
+        self.io_loop.call_at.assert_called_once_with(103.0, self.app.write_counter)
+
+    @gen_test
+    def test_thresholds_checked_after_drain(self):
+        pending = self.slow_writes()
+        self.app.incr('a')
+        drain = self.app.write_counter()
+        for name in 'bcd':
+            self.app.incr(name)
+        self.io_loop.call_later.assert_not_called()
+
+        pending[0].set_result(None)
+        yield drain
+        self.io_loop.call_later.assert_called_once_with(0, self.app.write_counter)
+
+
+class CheckFlushOptionsTest(FlushTestCase):
+
+    def assertRejected(self, name, value):
+        with mock.patch.object(options.mockable(), name, value):
+            self.assertRaises(tornado.options.Error, check_flush_options)
+
+    def test_defaults_accepted(self):
+        check_flush_options()
+
+    def test_bad_values_rejected(self):
+        self.assertRejected('flush_slice', 0)
+        self.assertRejected('flush_slice', -1)
+        self.assertRejected('flush_max_age', 0)
+        self.assertRejected('flush_max_keys', 0)
+        self.assertRejected('flush_max_delta', 0)
+        self.assertRejected('flush_jitter', -0.1)
+        self.assertRejected('flush_jitter', 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
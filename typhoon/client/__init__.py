@@ -16,26 +16,250 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from collections import defaultdict
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
 from tornado.options import define, options
 from tornado import httpclient
+from tornado.httputil import url_concat
 import tornado.ioloop
 from tornado.ioloop import PeriodicCallback
+import tornado.options
+
+
+# tornado only keeps the last occurrence of a multiple=True option, so
+# collect every occurrence here to allow `--target=a --target=b`
+_repeated = defaultdict(list)
+
+
+def repeatable(name, **kwargs):
+    define(name, multiple=True,
+           callback=lambda value: _repeated[name].extend(value), **kwargs)
+
 
+def repeated(name):
+    return _repeated[name] or options[name]
 
-define("target", default="http://starfighter.csh.rit.edu:8080/")
+
+repeatable("target", default=["http://starfighter.csh.rit.edu:8080/"],
+           help="URL to load, repeat or comma-separate for several targets")
+define("target_file", default=None,
+       help="file with one target URL per line, optionally followed by a weight")
+repeatable("weight", default=[], type=int,
+           help="weight for each --target, used by --distribution=weighted")
+define("distribution", default="round-robin",
+       help="how to spread requests over targets: round-robin, weighted or hash")
+repeatable("name", default=[],
+           help="counter name to send, repeat or comma-separate for several; "
+                "required by --distribution=hash")
+define("max_clients", default=10, type=int,
+       help="concurrent connections per target")
 define("requests", default=1000)
 
+DISTRIBUTIONS = ("round-robin", "weighted", "hash")
+
 fizz = 0
 factor = 0
+task_id = 0
+stats_dir = None
+targets = []
+plan = []
+
+
+class Target(object):
+    """A URL under load, with its own connection pool and stats"""
+
+    def __init__(self, url, weight=1):
+        self.url = url
+        self.weight = weight
+        self.client = httpclient.AsyncHTTPClient(
+            force_instance=True, max_clients=options.max_clients)
+        self.latencies = []
+        self.error_latencies = []
+        self.started = None
+        self.finished = None
+
+    def fetch(self, name=None):
+        url = self.url
+        if name is not None:
+            url = url_concat(url, {'name': name})
+        started = time.time()
+        if self.started is None:
+            self.started = started
+        tornado.ioloop.IOLoop.current().add_future(
+            self.client.fetch(url),
+            lambda future: self.record(future, started))
+
+    def record(self, future, started):
+        global fizz
+        fizz += 1
+        self.finished = time.time()
+        # Errors such as refused connections come back fast, keep them out of
+        # the percentiles so they don't make a broken node look quick
+        try:
+            response = future.result()
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            self.error_latencies.append(
+                response.request_time if response else self.finished - started)
+        else:
+            self.latencies.append(response.request_time)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'latencies': self.latencies,
+            'error_latencies': self.error_latencies,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+def report(stats):
+    """Summarise one target's stats, merged from every worker"""
+    url = stats[0]['url']
+    latencies = sorted(l for s in stats for l in s['latencies'])
+    error_latencies = [l for s in stats for l in s['error_latencies']]
+    done = len(latencies) + len(error_latencies)
+    if not done:
+        return "{}: no requests completed".format(url)
+
+    started = min(s['started'] for s in stats if s['started'] is not None)
+    finished = max(s['finished'] for s in stats if s['finished'] is not None)
+    line = "{}: {} requests, {:.1f} req/s".format(
+        url, done, done / max(finished - started, 1e-6))
+    if latencies:
+        ok = len(latencies)
+        line += ", latency mean {:.1f}ms p50 {:.1f}ms p99 {:.1f}ms".format(
+            1000 * sum(latencies) / ok,
+            1000 * latencies[int(ok * 0.50)],
+            1000 * latencies[min(int(ok * 0.99), ok - 1)])
+    if error_latencies:
+        line += ", {} errors (mean {:.1f}ms)".format(
+            len(error_latencies),
+            1000 * sum(error_latencies) / len(error_latencies))
+    return line
+
+
+def load_targets():
+    """Read (url, weight) pairs from --target/--weight or --target_file"""
+    weights = repeated("weight")
+    if options.target_file:
+        if weights:
+            raise tornado.options.Error(
+                "--weight can't be combined with --target_file, "
+                "put weights in the file instead")
+        entries = []
+        with open(options.target_file) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].split()
+                if not line:
+                    continue
+                try:
+                    weight = int(line[1]) if len(line) > 1 else 1
+                except ValueError:
+                    raise tornado.options.Error(
+                        "{}:{}: weight must be an integer".format(
+                            options.target_file, lineno))
+                entries.append((line[0], weight))
+        if not entries:
+            raise tornado.options.Error(
+                "No targets in {}".format(options.target_file))
+        if (options.distribution != "weighted" and
+                any(weight != 1 for url, weight in entries)):
+            raise tornado.options.Error(
+                "Weights in {} need --distribution=weighted".format(
+                    options.target_file))
+    else:
+        urls = repeated("target")
+        weights = weights or [1] * len(urls)
+        if len(weights) != len(urls):
+            raise tornado.options.Error(
+                "--weight needs one entry per --target")
+        entries = list(zip(urls, weights))
+
+    if any(weight < 1 for url, weight in entries):
+        raise tornado.options.Error("Target weights must be at least 1")
+    return entries
+
+
+def check_options():
+    """Reject a bad --distribution before any workers are forked"""
+    if options.distribution not in DISTRIBUTIONS:
+        raise tornado.options.Error(
+            "Unknown distribution {!r}, expected one of {}".format(
+                options.distribution, ", ".join(DISTRIBUTIONS)))
+    if options.distribution == "hash" and not repeated("name"):
+        raise tornado.options.Error("--distribution=hash needs --name")
+    if options.distribution != "weighted" and repeated("weight"):
+        raise tornado.options.Error("--weight needs --distribution=weighted")
+
+
+def schedule(count, offset=0):
+    """Return (target, name) pairs for `count` requests per --distribution.
+
+    Each worker passes its own offset so they don't all start on the same
+    target and leave the first one over-weighted."""
+    names = itertools.cycle(repeated("name") or [None])
+
+    if options.distribution == "hash":
+        names = [next(names) for _ in range(count)]
+        return [(targets[zlib.crc32(name.encode('utf8')) % len(targets)], name)
+                for name in names]
+
+    if options.distribution == "weighted":
+        picks = weighted_cycle(targets)
+    else:
+        picks = itertools.cycle(targets)
+    picks = itertools.islice(picks, offset, None)
+
+    return [(next(picks), next(names)) for _ in range(count)]
+
+
+def weighted_cycle(items):
+    """Smooth weighted round-robin, so heavy targets don't get bursts"""
+    total = sum(item.weight for item in items)
+    current = [0] * len(items)
+    while True:
+        for i, item in enumerate(items):
+            current[i] += item.weight
+        best = max(range(len(items)), key=current.__getitem__)
+        current[best] -= total
+        yield items[best]
+
 
 def main():
     import tornado.process
-    tornado.process.fork_processes(None)
 
-    import tornado.options
+    # Everything that can fail on bad input happens before forking, otherwise
+    # fork_processes keeps restarting workers that exit with the same error
     tornado.options.parse_command_line()
-    global factor
+    check_options()
+    entries = load_targets()
+
+    global factor, targets, plan, task_id, stats_dir
     factor = int(float(options.requests) / float(tornado.process.cpu_count()))
+    stats_dir = tempfile.mkdtemp(prefix="typhoon-")
+
+    try:
+        task_id = tornado.process.fork_processes(None)
+    except SystemExit:
+        # fork_processes exits the parent once every worker is done
+        print_report([url for url, weight in entries])
+        raise
+    except BaseException:
+        # Interrupted, or fork_processes gave up restarting workers
+        shutil.rmtree(stats_dir, ignore_errors=True)
+        raise
+
+    targets = [Target(url, weight) for url, weight in entries]
+    plan = schedule(factor, task_id)
 
     PeriodicCallback(is_done, 200).start()
 
@@ -44,19 +268,33 @@ def main():
     main_loop.start()
 
 
+def print_report(urls):
+    """Merge every worker's stats file and print one line per target"""
+    merged = [[] for _ in urls]
+    try:
+        for filename in os.listdir(stats_dir):
+            with open(os.path.join(stats_dir, filename)) as f:
+                for i, stats in enumerate(json.load(f)):
+                    merged[i].append(stats)
+    finally:
+        shutil.rmtree(stats_dir, ignore_errors=True)
+
+    for url, stats in zip(urls, merged):
+        if stats:
+            print(report(stats))
+        else:
+            print("{}: no worker reported stats".format(url))
+
+
 def is_done():
     global fizz
 
     if fizz >= factor-4:
-        print("Completed {} requests".format(fizz))
+        print("Worker {} completed {} requests".format(task_id, fizz))
+        with open(os.path.join(stats_dir, "{}.json".format(task_id)), "w") as f:
+            json.dump([target.stats() for target in targets], f)
         tornado.ioloop.IOLoop.current().stop()
 
 def request_all_things():
-    http_client = httpclient.AsyncHTTPClient()
-
-    def add_fizz(arg=None):
-        global fizz
-        fizz += 1
-
-    for i in range(0, int(factor)):
-        http_client.fetch(options.target, add_fizz)
+    for target, name in plan:
+        target.fetch(name)
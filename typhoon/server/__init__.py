@@ -16,11 +16,15 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import itertools
 import logging
+import random
 from collections import defaultdict
 
+from tornado.gen import Return, coroutine
 import tornado.ioloop
 from tornado.options import options
+import tornado.options
 import tornado.httpserver
 import tornado.web
 
@@ -44,23 +48,128 @@ class App(tornado.web.Application):
         assert settings.get('db', None) is not None
         self.client = BaseMongoClient('test', settings)
 
-        tornado.ioloop.PeriodicCallback(self.write_counter, 5000).start()
-
+        self._pending_delta = 0
+        self._first_pending = None
+        self._retry_at = None
+        self._flush_timeout = None
+        self._flush_now = False
+        self._flushing = False
+
+    def incr(self, name):
+        """Count one hit for `name`, scheduling a flush if one is due"""
+        if self._first_pending is None:
+            self._first_pending = tornado.ioloop.IOLoop.current().time()
+        self._counters[name] += 1
+        self._pending_delta += 1
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """Arm a flush for whichever comes first: too many pending names, too
+        many pending hits, or the oldest pending hit reaching flush_max_age.
+
+        The age deadline is jittered downwards so a fleet of servers started
+        together doesn't hit mongo in lockstep. Nothing is armed while a drain
+        is running, the drain calls back in here when it finishes. After a
+        drain with failed writes nothing fires before the retry time, so a
+        mongo outage can't turn into a busy loop."""
+        if self._flushing or self._flush_now or not self._counters:
+            return
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self._retry_at is not None:
+            if io_loop.time() < self._retry_at:
+                if self._flush_timeout is None:
+                    self._flush_timeout = io_loop.call_at(self._retry_at, self.write_counter)
+                return
+            self._retry_at = None
+
+        if (len(self._counters) >= options.flush_max_keys or
+                self._pending_delta >= options.flush_max_delta):
+            if self._flush_timeout is not None:
+                io_loop.remove_timeout(self._flush_timeout)
+            self._flush_now = True
+            self._flush_timeout = io_loop.call_later(0, self.write_counter)
+        elif self._flush_timeout is None:
+            jitter = random.uniform(0, options.flush_jitter)
+            deadline = (self._first_pending +
+                        options.flush_max_age * (1 - jitter) / 1000.0)
+            self._flush_timeout = io_loop.call_at(deadline, self.write_counter)
+
+    @coroutine
     def write_counter(self):
-        self.client = BaseMongoClient('test', settings)
-        keys = list(self._counters.keys())
-        for k in keys:
-            self.logger.info("Writing %s" % k)
-            self.client.update(
-                k,
+        """Drain the counter table into mongo, flush_slice names at a time.
+
+        Each slice's writes have to finish before the next slice is popped, so
+        a large table never has more than flush_slice updates in flight."""
+        self._flush_timeout = None
+        self._flush_now = False
+        if self._flushing or not self._counters:
+            return
+
+        self._flushing = True
+        failures = []
+        started = self._first_pending or tornado.ioloop.IOLoop.current().time()
+        self._first_pending = None
+        keys = iter(list(self._counters.keys()))
+        try:
+            while True:
+                batch = list(itertools.islice(keys, options.flush_slice))
+                if not batch:
+                    break
+                self.logger.info("Writing %d counters" % len(batch))
+                writes = []
+                for k in batch:
+                    count = self._counters.pop(k, 0)
+                    if count:
+                        self._pending_delta -= count
+                        writes.append(self._write_count(k, count, started))
+                errors = yield writes
+                failures.extend(e for e in errors if e is not None)
+        finally:
+            # Re-arm for any hits that arrived while we were draining, or any
+            # names left over if the drain was cut short
+            if not self._counters:
+                self._first_pending = None
+            elif self._first_pending is None:
+                self._first_pending = started
+            if failures:
+                delay = options.flush_max_age / 1000.0
+                self._retry_at = tornado.ioloop.IOLoop.current().time() + delay
+                self.logger.error("Failed writing %d counters, retrying in %.1fs: %s"
+                                  % (len(failures), delay, failures[0]))
+            self._flushing = False
+            self.schedule_flush()
+
+    @coroutine
+    def _write_count(self, name, count, since):
+        """Add `count` hits for `name` in mongo, putting them back in the
+        counter table and returning the error if the write fails"""
+        try:
+            yield self.client.update(
+                name,
                 {
                     '$inc': {
-                        'c': self._counters.pop(k),
+                        'c': count,
                     },
                 },
                 upsert=True,
                 attribute="n"
             )
+        except Exception as e:
+            self._counters[name] += count
+            self._pending_delta += count
+            if self._first_pending is None or since < self._first_pending:
+                self._first_pending = since
+            raise Return(e)
+
+
+def check_flush_options():
+    """Reject flush settings that would stall or spin the counter drain"""
+    for name in ('flush_max_keys', 'flush_max_delta', 'flush_max_age', 'flush_slice'):
+        if options[name] < 1:
+            raise tornado.options.Error("--%s must be at least 1" % name)
+    if not 0 <= options.flush_jitter <= 1:
+        raise tornado.options.Error("--flush_jitter must be between 0 and 1")
 
 
 def main():
@@ -68,6 +177,7 @@ def main():
 
     logger = logging.getLogger()
     tornado.options.parse_command_line()
+    check_flush_options()
     app = App()
     http_server = tornado.httpserver.HTTPServer(app, xheaders=True)
     http_server.listen(options.port)
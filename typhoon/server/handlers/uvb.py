@@ -23,5 +23,5 @@ import tornado.web
 class CountingHandler(tornado.web.RequestHandler):
     @coroutine
     def get(self):
-        self.application._counters[self.get_argument('name')] += 1
+        self.application.incr(self.get_argument('name'))
         self.write("yolo")
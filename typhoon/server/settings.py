@@ -52,6 +52,11 @@ TEMPLATE_ROOT = path(ROOT, 'templates')
 define("port", default=8080, help="run on the given port", type=int)
 define("config", default=None, help="tornado config file")
 define("debug", default=False, help="debug mode")
+define("flush_max_keys", default=1000, help="flush counters once this many names are pending", type=int)
+define("flush_max_delta", default=10000, help="flush counters once this many hits are pending", type=int)
+define("flush_max_age", default=5000, help="flush pending counters at most this many ms after the first hit", type=int)
+define("flush_jitter", default=0.2, help="fraction of flush_max_age to randomly shave off each age-triggered flush", type=float)
+define("flush_slice", default=100, help="number of counters written per IOLoop iteration while flushing", type=int)
 
 settings = {}
 settings['debug'] = DEPLOYMENT != DeploymentType.PRODUCTION or options.debug